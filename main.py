@@ -1,17 +1,41 @@
-from collections import defaultdict
 from typing import List, Optional, Tuple, Dict
-import re
-from itertools import combinations
 
 import numpy as np
-from PIL import Image
+import pandas as pd
+from PIL import Image, ImageOps
 import streamlit as st
 
+from receipt_core import (
+    build_split_options,
+    calculate_balances,
+    format_euro,
+    item_amount_display,
+    item_unit_price_display,
+    make_split,
+    parse_items,
+)
+
 # --- OCR deps / Streamlit Cloud tesseract path ---------------------------
+import io
+import os
 import shutil
+import threading
+
+# A single receipt is too small a job for Tesseract's OpenMP thread team to
+# pay off; the setup cost outweighs the parallelism. Must be set before
+# tesserocr loads libtesseract (the CLI inherits it from the environment).
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
 import pytesseract
 from pytesseract import TesseractNotFoundError
 
+try:
+    # Optional: keeps one Tesseract engine loaded in-process instead of
+    # spawning the CLI (and re-reading the 'nld' model) for every receipt.
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
 _tess = shutil.which("tesseract")
 if _tess:
     pytesseract.pytesseract.tesseract_cmd = _tess
@@ -21,201 +45,71 @@ else:
 
 # ----------------- OCR ---------------------------------------------------
 
-def extract_receipt_text_from_image(img: Image.Image) -> str:
-    img = img.convert("RGB")
-    return pytesseract.image_to_string(img, lang="nld")
-
-# ----------------- Parsing helpers --------------------------------------
-
-def euro_to_float(value: str) -> float:
-    """Convert receipt-style euro values such as '1,29' or '-0,57' to float."""
-    return float(value.replace(",", "."))
-
-
-def format_qty(value: Optional[float]) -> str:
-    """Human-friendly quantity display without unnecessary trailing zeros."""
-    if value is None:
-        return "1"
-    if float(value).is_integer():
-        return str(int(value))
-    return (f"{value:.3f}".rstrip("0").rstrip(".")).replace(".", ",")
-
-
-def make_item(
-    name: str,
-    price: float,
-    quantity: Optional[float] = None,
-    unit_price: Optional[float] = None,
-    unit_label: Optional[str] = None,
-    amount_text: Optional[str] = None,
-    is_discount: bool = False,
-) -> Dict:
-    return {
-        "name": name.strip(),
-        "quantity": quantity,
-        "unit_price": unit_price,
-        "unit_label": unit_label,
-        "amount_text": amount_text,
-        "is_discount": is_discount,
-        "price": price,
-    }
-
-
-def item_amount_display(item: Dict) -> str:
-    """Display only the amount, not the unit price calculation."""
-    if item.get("amount_text"):
-        return item["amount_text"]
-    if item.get("unit_label") and item.get("quantity") is not None:
-        return f"{format_qty(item['quantity'])} {item['unit_label']}"
-    return format_qty(item.get("quantity"))
-
-
-def item_unit_price_display(item: Dict) -> str:
-    unit_price = item.get("unit_price")
-    if unit_price is None:
-        return ""
-    unit_label = item.get("unit_label")
-    if unit_label:
-        return f"€{unit_price:.2f}/{unit_label}"
-    return f"€{unit_price:.2f}"
-
-# ----------------- Parsing ----------------------------------------------
-
-def parse_items(text: str) -> Tuple[List[Dict], Optional[float]]:
-    """
-    Parse Lidl-style receipt OCR text.
-
-    Handles:
-      - Regular item lines: name price tax-code
-      - Multi-buy item lines: name qty x unit_price total tax-code
-        Examples: 'Avocado 3 X 1,29 3,87 B', 'Penne Rigate HWG 2x 0,78 1,56 B'
-      - OCR variants such as X, x, Xx, xx, and ×
-      - Weight lines following an item: '1,064 kg x 2,98 EUR'
-      - Discount/adjustment rows: 'Actieprijs', 'In prijs verlaagd', 'Lidl Plus korting'
-      - Stops before checkout/tax/footer sections
-    """
-    items: List[Dict] = []
-    last_product_item: Optional[Dict] = None
-    total_price: Optional[float] = None
-
-    item_pattern = re.compile(
-        r"^\s*(?P<name>.+?)\s+"
-        r"(?:(?P<qty>\d+)\s*[xX×]+\s*(?P<unit_price>\d+,\d{2})\s+)?"
-        r"(?P<price>-?\d+,\d{2})\s*[A-Z]?\s*$",
-        re.IGNORECASE,
-    )
+def otsu_threshold(gray: np.ndarray) -> int:
+    """Otsu's global threshold for an 8-bit grayscale array."""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(hist * np.arange(256))
+    denom = w0 * w1
+    between = np.zeros(256)
+    np.divide((m0[-1] * w0 / w0[-1] - m0) ** 2, denom, out=between, where=denom > 0)
+    return int(between.argmax())
 
-    kg_pattern = re.compile(
-        r"^\s*(?P<qty>\d+,\d+)\s*(?P<unit>kg|g)\s*[xX×]+\s*(?P<unit_price>\d+,\d{2})\s*(?:EUR)?\s*$",
-        re.IGNORECASE,
-    )
 
-    discount_pattern = re.compile(
-        r"^\s*(?P<name>Actieprijs|In prijs verlaagd|Lidl Plus korting|KORTING(?:\s*\d+%)?)\s+"
-        r"(?P<price>-?\d+,\d{2})\s*$",
-        re.IGNORECASE,
-    )
+# Tesseract's runtime grows with pixel count, but receipts are tall and
+# narrow, so only the width is capped: a fixed (w, h) box would let the
+# height decide the scale and shrink the glyphs of long receipts.
+_OCR_MAX_WIDTH = 1600
 
-    total_line_pattern = re.compile(r"^\s*Totaal\s+(?P<total>\d+,\d{2})\s*$", re.IGNORECASE)
 
-    footer_start_pattern = re.compile(
-        r"^\s*(Aantal\b|Bankpas\b|Kopie Kaarthouder\b|Terminal\b|AID\b|DEBIT\b|Kaart\b|Volgnr\b|Betaling\b|%\b|Waarvan\b|DANK U WEL\b|Kortingscoupons\b|Aankoop gedaan bij\b)",
-        re.IGNORECASE,
-    )
+def preprocess_for_ocr(img: Image.Image) -> Image.Image:
+    """Downscale, grayscale, stretch contrast and binarize for Tesseract."""
+    gray = img.convert("L")
+    if gray.width > _OCR_MAX_WIDTH:
+        height = round(gray.height * _OCR_MAX_WIDTH / gray.width)
+        gray = gray.resize((_OCR_MAX_WIDTH, height), Image.Resampling.LANCZOS)
+    gray = ImageOps.autocontrast(gray)
+    threshold = otsu_threshold(np.asarray(gray))
+    return gray.point(lambda p: 255 if p > threshold else 0, mode="1")
+
 
-    for raw_line in text.splitlines():
-        raw = raw_line.strip()
-        if not raw:
-            continue
-
-        m_total = total_line_pattern.match(raw)
-        if m_total:
-            total_price = euro_to_float(m_total.group("total"))
-            break
-
-        if footer_start_pattern.match(raw):
-            continue
-
-        m_kg = kg_pattern.match(raw)
-        if m_kg and last_product_item:
-            qty_text = m_kg.group("qty")
-            unit = m_kg.group("unit").lower()
-            unit_price_text = m_kg.group("unit_price")
-            last_product_item["quantity"] = euro_to_float(qty_text)
-            last_product_item["unit_price"] = euro_to_float(unit_price_text)
-            last_product_item["unit_label"] = unit
-            last_product_item["amount_text"] = f"{qty_text} {unit}"
-            continue
-
-        m_disc = discount_pattern.match(raw)
-        if m_disc:
-            name = m_disc.group("name").strip()
-            price = euro_to_float(m_disc.group("price"))
-            items.append(make_item(name=name, price=price, is_discount=True))
-            continue
-
-        m_item = item_pattern.match(raw)
-        if m_item:
-            name = m_item.group("name").strip()
-            price = euro_to_float(m_item.group("price"))
-            qty = euro_to_float(m_item.group("qty")) if m_item.group("qty") else None
-            unit_price = euro_to_float(m_item.group("unit_price")) if m_item.group("unit_price") else None
-
-            item = make_item(
-                name=name,
-                quantity=qty,
-                unit_price=unit_price,
-                price=price,
-            )
-            items.append(item)
-            last_product_item = item
-
-    return items, total_price
-
-# ----------------- Dynamic splits (by participant names) -----------------
-
-def initials(name: str) -> str:
-    for ch in name.strip():
-        if ch.isalpha() or ch.isnumeric():
-            return ch.upper()
-    return name[:1].upper() if name else "?"
-
-
-def build_split_options(participants: List[str]) -> List[Dict]:
-    options: List[Dict] = []
-    cleaned = [p.strip() for p in participants if p.strip()]
-
-    seen = set()
-    ordered = []
-    for p in cleaned:
-        if p.lower() not in seen:
-            ordered.append(p)
-            seen.add(p.lower())
-
-    for r in range(1, len(ordered) + 1):
-        for combo in combinations(ordered, r):
-            label = "".join(initials(n) for n in combo)
-            options.append({"label": label, "members": list(combo)})
-
-    options.sort(key=lambda o: (len(o["members"]), o["label"]))
-    return options
-
-
-def calculate_balances(items: List[dict], splits: List[Dict], payer: str) -> Dict[str, float]:
-    costs = defaultdict(float)
-    for item, split in zip(items, splits):
-        people = split["members"]
-        if not people:
-            continue
-        per_person = round(item["price"] / len(people), 2)
-        for p in people:
-            costs[p] += per_person
-
-    balances = {}
-    for person, amount in costs.items():
-        if person != payer:
-            balances[person] = round(amount, 2)
-    return balances
+# Receipts are one column of text: PSM 6 (single uniform block) skips the
+# page layout analysis of the default PSM 3, and OEM 1 runs only the LSTM.
+_TESS_CONFIG = "--oem 1 --psm 6"
+
+
+@st.cache_resource
+def _tess_api():
+    """
+    Shared (tesserocr engine, lock) for all sessions, or None to use pytesseract.
+
+    The lock lives in the cached resource because Streamlit re-executes this
+    script in a fresh namespace on every rerun; a module-level lock would be
+    a different object per run while the engine is shared.
+    """
+    if tesserocr is None:
+        return None
+    try:
+        api = tesserocr.PyTessBaseAPI(
+            lang="nld", psm=tesserocr.PSM.SINGLE_BLOCK, oem=tesserocr.OEM.LSTM_ONLY
+        )
+    except RuntimeError:
+        # tesserocr could not find the 'nld' tessdata; the CLI path may still work
+        return None
+    return api, threading.Lock()
+
+
+def extract_receipt_text_from_image(img: Image.Image) -> str:
+    img = preprocess_for_ocr(img)
+    engine = _tess_api()
+    if engine is None:
+        return pytesseract.image_to_string(img, lang="nld", config=_TESS_CONFIG)
+    api, lock = engine
+    # PyTessBaseAPI is not thread-safe and Streamlit serves sessions from threads
+    with lock:
+        api.SetImage(img)
+        return api.GetUTF8Text()
 
 # ----------------- Streamlit UI -----------------------------------------
 
@@ -225,30 +119,46 @@ st.caption("Upload a receipt → OCR (Tesseract ‘nld’) → parse → assign
 
 if "receipt_items" not in st.session_state:
     st.session_state.receipt_items: List[dict] = []
-    st.session_state.total_price: Optional[float] = None
-    st.session_state.cur_index: int = 0
+    st.session_state.total_cents: Optional[int] = None
     st.session_state.splits: List[Dict] = []
     st.session_state.participants: List[str] = ["Kate", "George", "John"]
+    st.session_state._last_names_raw: str = ", ".join(st.session_state.participants)
     st.session_state.split_options: List[Dict] = build_split_options(st.session_state.participants)
     st.session_state.payer: Optional[str] = st.session_state.participants[0]
     st.session_state.started: bool = False
     st.session_state.ocr_text: Optional[str] = None
-    st.session_state.image_preview: Optional[np.ndarray] = None
+    st.session_state.image_preview: Optional[bytes] = None
+    # Part of the split form's widget keys; bumped for every new receipt so
+    # choices made for a previous receipt never pre-fill the next one.
+    st.session_state.receipt_token: int = 0
 
 
 def reset_state(full: bool = False):
+    st.session_state.receipt_token += 1
     st.session_state.receipt_items = []
-    st.session_state.total_price = None
-    st.session_state.cur_index = 0
+    st.session_state.total_cents = None
     st.session_state.splits = []
     st.session_state.started = False
     st.session_state.ocr_text = None
     st.session_state.image_preview = None
     if full:
         st.session_state.participants = ["Kate", "George", "John"]
+        st.session_state._last_names_raw = ", ".join(st.session_state.participants)
         st.session_state.split_options = build_split_options(st.session_state.participants)
         st.session_state.payer = st.session_state.participants[0] if st.session_state.participants else None
 
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def ocr_and_parse(image_bytes: bytes) -> Tuple[str, List[Dict], Optional[int]]:
+    """OCR and parse an uploaded receipt, memoized on the raw upload bytes."""
+    image = Image.open(io.BytesIO(image_bytes))
+    # JPEGs can decode straight to grayscale at a reduced DCT scale; a height
+    # of 1 leaves the scale to the width alone
+    image.draft("L", (_OCR_MAX_WIDTH, 1))
+    text = extract_receipt_text_from_image(image)
+    items, total_cents = parse_items(text)
+    return text, items, total_cents
+
 # --- Participants & OCR upload ------------------------------------------
 
 with st.expander("Participants & Upload", expanded=(len(st.session_state.receipt_items) == 0)):
@@ -258,12 +168,15 @@ with st.expander("Participants & Upload", expanded=(len(st.session_state.receipt
         help="Example: Kate, George, John",
     )
 
-    new_participants = [n.strip() for n in names_input.split(",") if n.strip()]
-    if new_participants and new_participants != st.session_state.participants:
-        st.session_state.participants = new_participants
-        st.session_state.split_options = build_split_options(new_participants)
-        if st.session_state.payer not in new_participants:
-            st.session_state.payer = new_participants[0]
+    # Every button click reruns this block; only re-parse when the text changed
+    if names_input != st.session_state._last_names_raw:
+        st.session_state._last_names_raw = names_input
+        new_participants = [n.strip() for n in names_input.split(",") if n.strip()]
+        if new_participants and new_participants != st.session_state.participants:
+            st.session_state.participants = new_participants
+            st.session_state.split_options = build_split_options(new_participants)
+            if st.session_state.payer not in new_participants:
+                st.session_state.payer = new_participants[0]
 
     colA, colB = st.columns([1, 1])
     with colA:
@@ -280,20 +193,21 @@ with st.expander("Participants & Upload", expanded=(len(st.session_state.receipt
 
     start_clicked = st.button("Start splitting", type="primary", disabled=(not file))
     if start_clicked and file:
-        image = Image.open(file).convert("RGB")
-        st.session_state.image_preview = np.array(image)
+        image_bytes = file.getvalue()
+        # st.image serves the original encoded upload; no decoded pixel copy
+        # lives in session state or gets re-encoded on every rerun.
+        st.session_state.image_preview = image_bytes
         with st.spinner("Scanning receipt with Tesseract (nld)…"):
             try:
-                text = extract_receipt_text_from_image(image)
+                text, items, total_cents = ocr_and_parse(image_bytes)
             except TesseractNotFoundError:
                 st.error("Tesseract OCR not found. On Streamlit Cloud, add `tesseract-ocr` and `tesseract-ocr-nld` to `packages.txt`, then reboot.")
                 st.stop()
         st.session_state.ocr_text = text
-        items, total_price = parse_items(text)
         st.session_state.receipt_items = items
-        st.session_state.total_price = total_price
+        st.session_state.total_cents = total_cents
         st.session_state.started = True
-        st.session_state.cur_index = 0
+        st.session_state.receipt_token += 1
         st.session_state.splits = []
 
 if st.session_state.image_preview is not None:
@@ -306,52 +220,76 @@ if st.session_state.ocr_text:
 # --- Splitting workflow --------------------------------------------------
 
 if st.session_state.started and len(st.session_state.receipt_items) > 0:
-    i = st.session_state.cur_index
     total_items = len(st.session_state.receipt_items)
 
-    if i < total_items:
-        item = st.session_state.receipt_items[i]
-        st.subheader(f"Item {i + 1}/{total_items}")
-
-        st.write(f"**Item:** {item['name']}")
-        st.write(f"**Amount:** {item_amount_display(item)}")
-        if item_unit_price_display(item):
-            st.write(f"**Unit price:** {item_unit_price_display(item)}")
-        st.write(f"**Price:** €{item['price']:.2f}")
-
-        cols = st.columns(min(6, len(st.session_state.split_options)))
-        for idx, opt in enumerate(st.session_state.split_options):
-            c = cols[idx % len(cols)]
-            label = opt["label"]
-            members = ", ".join(opt["members"])
-            if c.button(label, key=f"split_{i}_{label}", help=members):
-                st.session_state.splits.append(opt)
-                st.session_state.cur_index += 1
-                st.rerun()
-
-    if st.session_state.cur_index >= total_items:
+    if len(st.session_state.splits) < total_items:
+        st.subheader(f"Assign splits ({total_items} items)")
+
+        # One form for the whole receipt: choosing splits doesn't rerun the
+        # script, only the final submit does.
+        token = st.session_state.receipt_token
+        with st.form("split_form"):
+            for i, item in enumerate(st.session_state.receipt_items):
+                details = [item_amount_display(item), item_unit_price_display(item), format_euro(item["price_cents"])]
+                col_item, col_split, col_custom = st.columns([3, 2, 2])
+                col_item.markdown(f"**{item['name']}**  \n" + " · ".join(d for d in details if d))
+                col_split.selectbox(
+                    "Split",
+                    st.session_state.split_options,
+                    format_func=lambda opt: opt["label"] + "  (" + ", ".join(opt["members"]) + ")",
+                    index=None,
+                    placeholder="Choose a split",
+                    key=f"split_{token}_{i}",
+                    label_visibility="collapsed",
+                )
+                col_custom.multiselect(
+                    "Custom split",
+                    st.session_state.participants,
+                    key=f"custom_{token}_{i}",
+                    placeholder="…or pick who shares it",
+                    help="Overrides the split next to it, for groups that aren't listed.",
+                    label_visibility="collapsed",
+                )
+
+            if st.form_submit_button("Compute balances", type="primary"):
+                splits = []
+                missing = []
+                for i, item in enumerate(st.session_state.receipt_items):
+                    custom = st.session_state[f"custom_{token}_{i}"]
+                    if custom:
+                        splits.append(make_split([p for p in st.session_state.participants if p in custom]))
+                    elif st.session_state[f"split_{token}_{i}"] is not None:
+                        splits.append(st.session_state[f"split_{token}_{i}"])
+                    else:
+                        missing.append(item["name"])
+                # Every item needs an explicit choice; never charge a default split
+                if missing:
+                    st.error("Choose a split for every item. Missing: " + ", ".join(missing))
+                else:
+                    st.session_state.splits = splits
+                    st.rerun()
+
+    else:
         st.success("Splitting complete.")
         st.subheader("Items & splits")
 
-        import pandas as pd
-        rows = []
-        for it, sp in zip(st.session_state.receipt_items, st.session_state.splits):
-            rows.append({
-                "Item": it["name"],
-                "Amount": item_amount_display(it),
-                "Unit price": item_unit_price_display(it),
-                "Price (€)": f"{it['price']:.2f}",
-                "Split": sp["label"] + "  (" + ", ".join(sp["members"]) + ")",
-            })
-        df = pd.DataFrame(rows)
+        receipt_items = st.session_state.receipt_items
+        splits = st.session_state.splits
+        df = pd.DataFrame({
+            "Item": [it["name"] for it in receipt_items],
+            "Amount": [item_amount_display(it) for it in receipt_items],
+            "Unit price": [item_unit_price_display(it) for it in receipt_items],
+            "Price (€)": [f"{it['price_cents'] / 100:.2f}" for it in receipt_items],
+            "Split": [sp["label"] + "  (" + ", ".join(sp["members"]) + ")" for sp in splits],
+        })
         st.dataframe(df, use_container_width=True)
 
         payer_name = st.session_state.payer
-        total_price = st.session_state.total_price or sum(it["price"] for it in st.session_state.receipt_items)
+        total_cents = st.session_state.total_cents or sum(it["price_cents"] for it in st.session_state.receipt_items)
 
         st.markdown("---")
         st.subheader("Totals")
-        st.write(f"**{payer_name}** paid **€{total_price:.2f}** in total.")
+        st.write(f"**{payer_name}** paid **{format_euro(total_cents)}** in total.")
 
         balances = calculate_balances(st.session_state.receipt_items, st.session_state.splits, payer_name)
 
@@ -359,8 +297,8 @@ if st.session_state.started and len(st.session_state.receipt_items) > 0:
         for person in st.session_state.participants:
             if person == payer_name:
                 continue
-            amount = balances.get(person, 0.0)
-            st.write(f"**{person}** pays **{payer_name}** €{amount:.2f}")
+            amount = balances.get(person, 0)
+            st.write(f"**{person}** pays **{payer_name}** {format_euro(amount)}")
 
         st.markdown("---")
         col1, col2 = st.columns(2)
@@ -0,0 +1,292 @@
+"""
+Receipt parsing and bill-splitting logic used by main.py.
+
+Kept free of Streamlit/OCR imports so it can optionally be compiled into a
+C extension with ``mypyc receipt_core.py``; the resulting .so is picked up
+by the same import.
+"""
+from collections import defaultdict
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+import re
+from itertools import combinations
+
+# ----------------- Parsing helpers --------------------------------------
+
+def euro_to_float(value: str) -> float:
+    """Convert receipt-style decimals such as '1,064' to float (used for quantities)."""
+    return float(value.replace(",", "."))
+
+
+def euro_to_cents(value: str) -> int:
+    """Convert receipt-style euro values such as '1,29' or '-0,57' to integer cents."""
+    # Prices always carry exactly two decimals, so dropping the comma gives cents.
+    return int(value.replace(",", ""))
+
+
+def format_euro(cents: int) -> str:
+    return f"€{cents / 100:.2f}"
+
+
+def format_qty(value: Optional[float]) -> str:
+    """Human-friendly quantity display without unnecessary trailing zeros."""
+    if value is None:
+        return "1"
+    if float(value).is_integer():
+        return str(int(value))
+    return (f"{value:.3f}".rstrip("0").rstrip(".")).replace(".", ",")
+
+
+def make_item(
+    name: str,
+    price_cents: int,
+    quantity: Optional[float] = None,
+    unit_price_cents: Optional[int] = None,
+    unit_label: Optional[str] = None,
+    amount_text: Optional[str] = None,
+    is_discount: bool = False,
+) -> Dict[str, Any]:
+    return {
+        "name": name.strip(),
+        "quantity": quantity,
+        "unit_price_cents": unit_price_cents,
+        "unit_label": unit_label,
+        "amount_text": amount_text,
+        "is_discount": is_discount,
+        "price_cents": price_cents,
+    }
+
+
+def item_amount_display(item: Dict[str, Any]) -> str:
+    """Display only the amount, not the unit price calculation."""
+    if item.get("amount_text"):
+        return item["amount_text"]
+    if item.get("unit_label") and item.get("quantity") is not None:
+        return f"{format_qty(item['quantity'])} {item['unit_label']}"
+    return format_qty(item.get("quantity"))
+
+
+def item_unit_price_display(item: Dict[str, Any]) -> str:
+    unit_price_cents = item.get("unit_price_cents")
+    if unit_price_cents is None:
+        return ""
+    unit_label = item.get("unit_label")
+    if unit_label:
+        return f"{format_euro(unit_price_cents)}/{unit_label}"
+    return format_euro(unit_price_cents)
+
+# ----------------- Parsing ----------------------------------------------
+
+# Item lines are matched from the right: the greedy head runs to the end of
+# the line and only backs off over the short price/tax-code tail, instead of
+# growing a lazy name one character at a time. A multi-buy "qty x unit_price"
+# suffix is then split off the head with the same right-anchored approach.
+_ITEM_RE = re.compile(
+    r"^\s*(?P<head>.*\S)\s+(?P<price>-?\d+,\d{2})\s*[A-Z]?\s*$",
+    re.IGNORECASE,
+)
+
+_MULTIBUY_RE = re.compile(
+    r"^(?P<name>.*\S)\s+(?P<qty>\d+)\s*[xX×]+\s*(?P<unit_price>\d+,\d{2})$",
+    re.IGNORECASE,
+)
+
+_KG_RE = re.compile(
+    r"^\s*(?P<qty>\d+,\d+)\s*(?P<unit>kg|g)\s*[xX×]+\s*(?P<unit_price>\d+,\d{2})\s*(?:EUR)?\s*$",
+    re.IGNORECASE,
+)
+
+_DISCOUNT_RE = re.compile(
+    r"^\s*(?P<name>Actieprijs|In prijs verlaagd|Lidl Plus korting|KORTING(?:\s*\d+%)?)\s+"
+    r"(?P<price>-?\d+,\d{2})\s*$",
+    re.IGNORECASE,
+)
+
+# Lower-case leading words of _DISCOUNT_RE. For ASCII text lower() agrees
+# exactly with IGNORECASE, so an ASCII line starting with none of them can
+# skip the discount regex; non-ASCII prefixes (e.g. 'İn prijs', which
+# IGNORECASE matches) always go to the regex.
+_DISCOUNT_PREFIXES = ("actieprijs", "in prijs verlaagd", "lidl plus korting", "korting")
+_DISCOUNT_PREFIX_LEN = max(map(len, _DISCOUNT_PREFIXES))
+
+_TOTAL_RE = re.compile(r"^\s*Totaal\s+(?P<total>\d+,\d{2})\s*$", re.IGNORECASE)
+
+_FOOTER_RE = re.compile(
+    r"^\s*(Aantal\b|Bankpas\b|Kopie Kaarthouder\b|Terminal\b|AID\b|DEBIT\b|Kaart\b|Volgnr\b|Betaling\b|%\b|Waarvan\b|DANK U WEL\b|Kortingscoupons\b|Aankoop gedaan bij\b)",
+    re.IGNORECASE,
+)
+
+
+def _is_price_token(tok: str) -> bool:
+    """True for a standalone receipt amount such as '1,29' or '-0,57'."""
+    whole, sep, frac = tok.partition(",")
+    if whole[:1] == "-":
+        whole = whole[1:]
+    return bool(sep) and len(frac) == 2 and frac.isdecimal() and whole.isdecimal()
+
+
+def _split_price_tail(raw: str) -> Optional[Tuple[str, str]]:
+    """
+    Split a plain 'name ... 1,29 B' item line into (head, price) with str ops.
+
+    Returns None for any other token shape (e.g. '0,59B' with the tax code
+    glued on); the caller then falls back to _ITEM_RE.
+    """
+    parts = raw.rsplit(None, 1)
+    if len(parts) == 2 and len(parts[1]) == 1 and parts[1].isascii() and parts[1].isalpha():
+        parts = parts[0].rsplit(None, 1)
+    if len(parts) == 2 and _is_price_token(parts[1]):
+        return parts[0], parts[1]
+    return None
+
+
+def parse_items(text: str) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    """
+    Parse Lidl-style receipt OCR text.
+
+    Handles:
+      - Regular item lines: name price tax-code
+      - Multi-buy item lines: name qty x unit_price total tax-code
+        Examples: 'Avocado 3 X 1,29 3,87 B', 'Penne Rigate HWG 2x 0,78 1,56 B'
+      - OCR variants such as X, x, Xx, xx, and ×
+      - Weight lines following an item: '1,064 kg x 2,98 EUR'
+      - Discount/adjustment rows: 'Actieprijs', 'In prijs verlaagd', 'Lidl Plus korting'
+      - Stops before checkout/tax/footer sections
+
+    Prices and the receipt total are returned as integer cents.
+    """
+    items: List[Dict[str, Any]] = []
+    last_product_item: Optional[Dict[str, Any]] = None
+    total_cents: Optional[int] = None
+
+    for raw in map(str.strip, text.splitlines()):
+        # Every line we act on (total, weight, discount, item) carries a
+        # comma-decimal and ends in a digit, tax code or "EUR"; skip headers,
+        # addresses and barcodes before running any regex.
+        if "," not in raw or not raw[-1].isalnum():
+            continue
+
+        m_total = _TOTAL_RE.match(raw)
+        if m_total:
+            total_cents = euro_to_cents(m_total.group("total"))
+            break
+
+        if _FOOTER_RE.match(raw):
+            continue
+
+        m_kg = _KG_RE.match(raw)
+        if m_kg and last_product_item:
+            qty_text = m_kg.group("qty")
+            unit = m_kg.group("unit").lower()
+            unit_price_text = m_kg.group("unit_price")
+            last_product_item["quantity"] = euro_to_float(qty_text)
+            last_product_item["unit_price_cents"] = euro_to_cents(unit_price_text)
+            last_product_item["unit_label"] = unit
+            last_product_item["amount_text"] = f"{qty_text} {unit}"
+            continue
+
+        head = raw[:_DISCOUNT_PREFIX_LEN]
+        if head.isascii() and not head.lower().startswith(_DISCOUNT_PREFIXES):
+            m_disc = None
+        else:
+            m_disc = _DISCOUNT_RE.match(raw)
+        if m_disc:
+            name = m_disc.group("name").strip()
+            price_cents = euro_to_cents(m_disc.group("price"))
+            items.append(make_item(name=name, price_cents=price_cents, is_discount=True))
+            continue
+
+        tail = _split_price_tail(raw)
+        if tail is None:
+            m_item = _ITEM_RE.match(raw)
+            if m_item:
+                tail = m_item.group("head"), m_item.group("price")
+        if tail:
+            name, price_text = tail
+            price_cents = euro_to_cents(price_text)
+            qty: Optional[float] = None
+            unit_price_cents: Optional[int] = None
+            # A multi-buy head always ends in the ',dd' of its unit price
+            m_multi = _MULTIBUY_RE.match(name) if name[-3:-2] == "," else None
+            if m_multi:
+                name = m_multi.group("name")
+                qty = euro_to_float(m_multi.group("qty"))
+                unit_price_cents = euro_to_cents(m_multi.group("unit_price"))
+            name = name.strip()
+
+            item = make_item(
+                name=name,
+                quantity=qty,
+                unit_price_cents=unit_price_cents,
+                price_cents=price_cents,
+            )
+            items.append(item)
+            last_product_item = item
+
+    return items, total_cents
+
+# ----------------- Dynamic splits (by participant names) -----------------
+
+def initials(name: str) -> str:
+    stripped = name.strip()
+    # Common case: the name already starts with a letter or digit
+    if stripped[:1].isalnum():
+        return stripped[0].upper()
+    fallback = name[:1].upper() if name else "?"
+    return next((ch.upper() for ch in stripped if ch.isalnum()), fallback)
+
+
+def make_split(members: List[str]) -> Dict[str, Any]:
+    return {"label": "".join(initials(n) for n in members), "members": list(members)}
+
+
+def build_split_options(participants: List[str]) -> List[Dict[str, Any]]:
+    """
+    Preset splits: each person alone, every pair, and everyone together.
+
+    Generating every subset would be 2^N - 1 options (and buttons); other
+    groups are built ad hoc with make_split instead.
+    """
+    return list(_split_options_cached(tuple(participants)))
+
+
+# Streamlit rebuilds the options on reruns with the same participant list;
+# the option dicts are shared between callers and must not be mutated.
+@lru_cache(maxsize=32)
+def _split_options_cached(participants: Tuple[str, ...]) -> Tuple[Dict[str, Any], ...]:
+    options: List[Dict[str, Any]] = []
+    cleaned = [p.strip() for p in participants if p.strip()]
+
+    # Case-insensitive de-dup that keeps the first spelling and position
+    ordered_map: Dict[str, str] = {}
+    for p in cleaned:
+        ordered_map.setdefault(p.lower(), p)
+    ordered = list(ordered_map.values())
+
+    for r in sorted({1, 2, len(ordered)} & set(range(1, len(ordered) + 1))):
+        for combo in combinations(ordered, r):
+            options.append(make_split(list(combo)))
+
+    options.sort(key=lambda o: (len(o["members"]), o["label"]))
+    return tuple(options)
+
+
+def calculate_balances(items: List[Dict[str, Any]], splits: List[Dict[str, Any]], payer: str) -> Dict[str, int]:
+    """Cents each non-payer owes the payer.
+
+    An item's price is split evenly in whole cents; any leftover cents go one
+    each to the first members of the split, so the shares always add up to
+    the item price.
+    """
+    # A plain integer loop on purpose: receipts have tens of items, and at
+    # that size building NumPy arrays costs more than the arithmetic saved.
+    costs: Dict[str, int] = defaultdict(int)
+    for item, split in zip(items, splits):
+        people = split["members"]
+        if not people:
+            continue
+        per_person, leftover = divmod(item["price_cents"], len(people))
+        for idx, p in enumerate(people):
+            costs[p] += per_person + (idx < leftover)
+
+    return {person: amount for person, amount in costs.items() if person != payer}